@@ -1,9 +1,35 @@
 import argparse
+import bisect
+import heapq
 import json
 import os
+import signal
+import sys
+import time
 
 import boto3
 
+PRICE_KEYS = [
+    "price_ondemand",
+    "price_nuri_1yr_standard",
+    "price_nuri_3yr_standard",
+    "price_nuri_1yr_convertible",
+    "price_nuri_3yr_convertible",
+]
+UNIT_KEYS = ["per_vcpu", "per_core", "per_gib"]
+SORT_BY_KEYS = {
+    "id": "id",
+    "type": "instance_type",
+    "vcpu": "vcpu_value",
+    "cores": "cores_value",
+    "memory": "memory_gigas",
+    "ondemand": "price_ondemand",
+    "nuri3ystd": "price_nuri_3yr_standard",
+    "nuri1ystd": "price_nuri_1yr_standard",
+    "nuri3yconv": "price_nuri_3yr_convertible",
+    "nuri1yconv": "price_nuri_1yr_convertible",
+}
+
 # Instance Types
 def describe_instance_types(region_name: str) -> dict:
     resp = []
@@ -74,6 +100,13 @@ def load_price_list(region_name: str, operating_system: str) -> dict:
     # Get price list from file
     with open(price_list_file_name) as f:
         price_list = json.load(f)
+
+    # Files saved before unit prices existed are updated in place
+    if any(f"{PRICE_KEYS[0]}_{UNIT_KEYS[0]}" not in x for x in price_list):
+        for x in price_list:
+            add_unit_prices(x)
+        with open(price_list_file_name, "w") as f:
+            json.dump(price_list, f, indent=4)
     return price_list
 
 def normalize_price_list_from_json(price_list_json: dict, instance_types: dict) -> list[dict]:
@@ -145,6 +178,24 @@ def convert_attributes(instance_price: dict) -> dict:
     if "processorFeatures" in instance_price["product"]["attributes"]:
         instance_price["processor_features"] = [ x.strip().lower() for x in str(instance_price["product"]["attributes"]["processorFeatures"]).split(";") ]
 
+    # Price per vCPU, per Core and per GiB
+    instance_price = add_unit_prices(instance_price)
+
+    return instance_price
+
+def add_unit_prices(instance_price: dict) -> dict:
+    # Ex: price_ondemand_per_vcpu, price_nuri_3yr_standard_per_gib
+    # Price zero means it is not available, so unit price is zero too
+    units = {
+        "per_vcpu": instance_price["vcpu_value"],
+        "per_core": instance_price["cores_value"],
+        "per_gib": instance_price["memory_gigas"],
+    }
+    for price_key in PRICE_KEYS:
+        for unit_key in UNIT_KEYS:
+            unit_value = units[unit_key]
+            price = instance_price[price_key]
+            instance_price[f"{price_key}_{unit_key}"] = price / unit_value if price > 0 and unit_value > 0 else 0
     return instance_price
 
 def get_price_ondemand(on_demand: dict) -> float:
@@ -155,12 +206,57 @@ def get_price_ondemand(on_demand: dict) -> float:
     print("ERROR - OnDemand price, please investigate!")
 
 
-# Price list sorted
-def price_list_sorted(price_list: list[dict], key: str) -> list[dict]:
-    only_valid_price = [ x for x in price_list if key in x and x[key] > 0 ]
-    list_sorted = sorted(only_valid_price, key=lambda x: (x[key], x["id"]))
-    #list_sorted = sorted(only_valid_price, key=lambda x: x[key])
-    return list_sorted
+# Price table
+def build_price_table(price_list: list[dict]) -> dict:
+    # Orders are sorted on first use and kept, so each one is sorted only once
+    # and queries walk them without sorting again or changing the records
+    return {
+        "records": price_list,
+        "price_orders": {},
+        "sort_orders": {},
+    }
+
+def get_price_order(table: dict, price_key: str) -> list[int]:
+    if price_key not in table["price_orders"]:
+        price_list = table["records"]
+        only_valid_price = [ index for index, x in enumerate(price_list) if price_key in x and x[price_key] > 0 ]
+        table["price_orders"][price_key] = sorted(only_valid_price, key=lambda index: (price_list[index][price_key], price_list[index]["id"]))
+    return table["price_orders"][price_key]
+
+def get_sort_order(table: dict, sort_by: str, reverse: bool) -> list[int]:
+    if (sort_by, reverse) not in table["sort_orders"]:
+        price_list = table["records"]
+        key = SORT_BY_KEYS[sort_by]
+        if reverse:
+            # Sort from the end and reverse, so equal values keep the loaded order like sorted(reverse=True)
+            order = sorted(reversed(range(len(price_list))), key=lambda index: price_list[index][key])
+            order.reverse()
+        else:
+            order = sorted(range(len(price_list)), key=lambda index: price_list[index][key])
+        table["sort_orders"][(sort_by, reverse)] = order
+    return table["sort_orders"][(sort_by, reverse)]
+
+def get_instance_sorted(table: dict, sort_by: str, reverse: bool) -> list[dict]:
+    records = table["records"]
+    return [ records[index] for index in get_sort_order(table, sort_by, reverse) ]
+
+def get_instance_selected(table: dict, price_key: str, mask: any) -> list[dict]:
+    # Only used to show what was selected on debug
+    records = table["records"]
+    return [ records[index] for index in get_price_order(table, price_key) if mask(records[index]) ]
+
+def select_lowest_price(table: dict, price_key: str, mask: any) -> dict:
+    # Price order is (price, id) and duplicated prices keep the last one,
+    # so it is the highest id among the ones with lowest price
+    records = table["records"]
+    selected = None
+    for index in get_price_order(table, price_key):
+        x = records[index]
+        if selected is not None and x[price_key] > selected[price_key]:
+            break
+        if mask(x):
+            selected = x
+    return selected
 
 
 # Get Instance
@@ -189,75 +285,66 @@ def remove_duplicate_from_beginning(seq: list, key: str) -> list:
 #             return cpu_value - limit_reduce
 #     return cpu_value
 
-def get_right_size_instance(price_list: list[dict], price_key: str, memory: float, cpu_key: str, cpu_value: int, args: any) -> list[dict]: # , memory_limits: list[tuple], cpu_limits: list[tuple]
-    filtered = [ x for x in price_list if x["memory_gigas"] <= memory  ] # and x[cpu_key] <= cpu_value
+def get_right_size_instance(table: dict, price_key: str, memory: float, cpu_key: str, cpu_value: int, args: any) -> dict: # , memory_limits: list[tuple], cpu_limits: list[tuple]
+    records = table["records"]
+    price_order = get_price_order(table, price_key)
+
+    def memory_mask(x: dict) -> bool:
+        return x["memory_gigas"] <= memory # and x[cpu_key] <= cpu_value
     if args.debug_right_size:
         print(f">>> Filtered by memory: <= {memory}")
-        print_instance(filtered, args)
+        print_instance(get_instance_selected(table, price_key, memory_mask), args)
         print()
 
-    # Sort to get the max memory from filter before
-    max_memory = max([x["memory_gigas"] for x in filtered])
+    # Get the max memory from filter before
+    max_memory = max((records[index]["memory_gigas"] for index in price_order if memory_mask(records[index])), default=None)
+    if max_memory is None:
+        raise ValueError(f"No instance type with memory <= '{memory}'")
     if args.debug_right_size:
         print(f">>> Max memory: {max_memory}")
         print()
 
-    # Filter again to get only the ones with max memory
-    filtered = [ x for x in filtered if x["memory_gigas"] == max_memory ]
+    allow_reduce_cpu = args.allow_reduce_cpu
+    def max_memory_mask(x: dict) -> bool:
+        # Only the ones with max memory
+        return x["memory_gigas"] == max_memory and (allow_reduce_cpu or x[cpu_key] >= cpu_value)
     if args.debug_right_size:
         print(f">>> Filtered by memory: == {memory}")
-        print_instance(filtered, args)
+        print_instance(get_instance_selected(table, price_key, lambda x: x["memory_gigas"] == max_memory), args)
         print()
-
-    allow_reduce_cpu = args.allow_reduce_cpu
-    if args.debug_right_size:
         print(f">>> Allow Reduce CPU: {allow_reduce_cpu}")
         print()
-    if not allow_reduce_cpu:
-        filtered = [ x for x in filtered if x[cpu_key] >= cpu_value ]
-        if args.debug_right_size:
+        if not allow_reduce_cpu:
             print(f">>> Filtered by '{cpu_key}': >= {cpu_value}")
-            print_instance(filtered, args)
+            print_instance(get_instance_selected(table, price_key, max_memory_mask), args)
             print()
 
-    # Add proximity to cpu
-    cpu_proximity_list = []
-    for x in filtered:
-        cpu_proximity = abs(cpu_value - x[cpu_key])
-        #print(f">>> {cpu_proximity} = abs({cpu_value} - {x[cpu_key]})")
-        x["cpu_proximity"] = cpu_proximity
-        cpu_proximity_list.append(cpu_proximity)
+    # Proximity to cpu, not saved on the records, they are shared by every query
     if args.debug_right_size:
+        cpu_proximity_list = [ abs(cpu_value - x[cpu_key]) for x in get_instance_selected(table, price_key, max_memory_mask) ]
         print(f">>> CPU Proximity: {cpu_proximity_list}")
         print()
 
-    # Filter memory list to get the ones with min cpu proximity
-    min_proximity = min(cpu_proximity_list)
+    # Min cpu proximity from filter before
+    min_proximity = min((abs(cpu_value - records[index][cpu_key]) for index in price_order if max_memory_mask(records[index])), default=None)
+    if min_proximity is None:
+        raise ValueError(f"No instance type with memory == '{max_memory}' and '{cpu_key}' >= '{cpu_value}'")
     if args.debug_right_size:
         print(f">>> Min CPU Proximity: == {min_proximity}")
         print()
 
-    filtered = [ x for x in filtered if x["cpu_proximity"] == min_proximity ]
+    def min_proximity_mask(x: dict) -> bool:
+        return max_memory_mask(x) and abs(cpu_value - x[cpu_key]) == min_proximity
     if args.debug_right_size:
-        print(f">>> Filtered by CPU Proximity: == {min_proximity}")
-        print_instance(filtered, args)
-        print()
-
-    # Sort to get the min price
-    price_sorted = sorted(filtered, key=lambda x: (x[price_key], x["id"]))
-    if args.debug_right_size:
-        print(f">>> Sorted by: '{price_key}' and 'id'")
+        print(f">>> Filtered by CPU Proximity: == {min_proximity}, sorted by: '{price_key}' and 'id'")
+        price_sorted = get_instance_selected(table, price_key, min_proximity_mask)
         print_instance(price_sorted, args)
         print()
-
-    # Remove the ones with same price
-    dedup = remove_duplicate_from_beginning(price_sorted, price_key)
-    if args.debug_right_size:
         print(f">>> Dedup by: '{price_key}'")
-        print_instance(dedup, args)
+        print_instance(remove_duplicate_from_beginning(price_sorted, price_key), args)
         print()
 
-    selected = dedup[0]
+    selected = select_lowest_price(table, price_key, min_proximity_mask)
     if args.debug_right_size:
         print(f">>> Selected")
         print_instance([selected], args)
@@ -265,27 +352,21 @@ def get_right_size_instance(price_list: list[dict], price_key: str, memory: floa
 
     return selected
 
-def get_direct_match_instance(price_list: list[dict], price_key: str, memory: float, cpu_key: str, cpu_value: int, args: any) -> list[dict]: # , memory_limits: list[tuple], cpu_limits: list[tuple]
-    filtered = [ x for x in price_list if x["memory_gigas"] >= memory and x[cpu_key] >= cpu_value ]
+def get_direct_match_instance(table: dict, price_key: str, memory: float, cpu_key: str, cpu_value: int, args: any) -> dict: # , memory_limits: list[tuple], cpu_limits: list[tuple]
+    def direct_match_mask(x: dict) -> bool:
+        return x["memory_gigas"] >= memory and x[cpu_key] >= cpu_value
     if args.debug_direct_match:
-        print(f">>> Filtered by memory: >= '{memory}' and '{cpu_key}' >= '{cpu_value}'")
-        print_instance(filtered, args)
-        print()
-
-    # Sort to get the min price
-    price_sorted = sorted(filtered, key=lambda x: (x[price_key], x["id"]))
-    if args.debug_direct_match:
-        print(f">>> Sorted by: '{price_key}' and 'id'")
+        print(f">>> Filtered by memory: >= '{memory}' and '{cpu_key}' >= '{cpu_value}', sorted by: '{price_key}' and 'id'")
+        price_sorted = get_instance_selected(table, price_key, direct_match_mask)
         print_instance(price_sorted, args)
         print()
-
-    dedup = remove_duplicate_from_beginning(price_sorted, price_key)
-    if args.debug_direct_match:
         print(f">>> Dedup by: '{price_key}'")
-        print_instance(dedup, args)
+        print_instance(remove_duplicate_from_beginning(price_sorted, price_key), args)
         print()
 
-    selected = dedup[0]
+    selected = select_lowest_price(table, price_key, direct_match_mask)
+    if selected is None:
+        raise ValueError(f"No instance type with memory >= '{memory}' and '{cpu_key}' >= '{cpu_value}'")
     if args.debug_direct_match:
         print(f">>> Selected")
         print_instance([selected], args)
@@ -294,52 +375,439 @@ def get_direct_match_instance(price_list: list[dict], price_key: str, memory: fl
     return selected
 
 
-def print_instance_recommendation(price_list: list[dict], instances_to_match: list[tuple], price_key: str, cpu_key: str, args: any) -> None: # , memory_limits: list[tuple], cpu_limits: list[tuple]
+def get_instance_recommendation(table: dict, instance_to_match: tuple, price_key: str, cpu_key: str, args: any) -> tuple:
+    memory, cpu_value = instance_to_match
+    # A side without instance type is left empty, only when both are empty there is no recommendation
+    errors = []
+    try:
+        right_size = get_right_size_instance(table, price_key, memory, cpu_key, cpu_value, args) # , memory_limits, cpu_limits
+    except ValueError as e:
+        right_size = None
+        errors.append(f"right-size: {e}")
+    try:
+        direct_match = get_direct_match_instance(table, price_key, memory, cpu_key, cpu_value, args) # , memory_limits, cpu_limits
+    except ValueError as e:
+        direct_match = None
+        errors.append(f"direct-match: {e}")
+    if right_size is None and direct_match is None:
+        raise ValueError("; ".join(errors))
+    for error in errors:
+        print(f"WARNING - CPU '{cpu_value}' and memory '{memory}' without {error}", file=sys.stderr)
+    return (right_size, direct_match, memory, cpu_value)
+
+def print_recommendation_header(args: any) -> None:
+    if args.output == "table" and args.table_header:
+        print(f'{"CPU":6} {"Mem":6}   {"Instance Type":20} {"vCPU":6} {"Cores":6} {"Memory GiB":12}   {"USD":<10}', end="")
+        print("  |  ", end="")
+        print(f'{"Instance Type":20} {"vCPU":6} {"Cores":6} {"Memory GiB":12}   {"USD":<10}')
+        print(f'{"-" * 6} {"-" * 6}   {"-" * 20} {"-" * 6} {"-" * 6} {"-" * 12}   {"-" * 10}', end="")
+        print("  |  ", end="")
+        print(f'{"-" * 20} {"-" * 6} {"-" * 6} {"-" * 12}   {"-" * 10}')
+
+def print_recommendation_row(recommendation: tuple, price_key: str) -> None:
+    x, y, memory, cpu_value = recommendation
+    print(f'{cpu_value:6} {memory:6}   ', end="")
+    print_recommendation_instance(x, price_key)
+    print("  |  ", end="")
+    print_recommendation_instance(y, price_key)
+    print()
+
+def print_recommendation_instance(x: dict, price_key: str) -> None:
+    # Empty when right-size or direct-match has no instance type
+    if x is None:
+        print(f'{"-":20} {"-":>6} {"-":>6} {"-":>12}   {"-":<10}', end="")
+        return
+    print(f'{x["instance_type"]:20} {x["vcpu_value"]:6} {x["cores_value"]:6} {x["memory_gigas"]:12}   {x[price_key]:<10}', end="")
+
+def print_instance_recommendation(table: dict, instances_to_match: list[tuple], price_key: str, cpu_key: str, args: any) -> None: # , memory_limits: list[tuple], cpu_limits: list[tuple]
     recommendations = []
     for instance_to_match in instances_to_match:
-        memory, cpu_value = instance_to_match
-        right_size = get_right_size_instance(price_list, price_key, memory, cpu_key, cpu_value, args) # , memory_limits, cpu_limits
-        direct_match = get_direct_match_instance(price_list, price_key, memory, cpu_key, cpu_value, args) # , memory_limits, cpu_limits
-        recommendations.append((right_size, direct_match, memory, cpu_value))
+        recommendations.append(get_instance_recommendation(table, instance_to_match, price_key, cpu_key, args))
 
     output = args.output
     if output == "table":
-        table_header = args.table_header
-        if table_header:
-            print(f'{"CPU":6} {"Mem":6}   {"Instance Type":20} {"vCPU":6} {"Cores":6} {"Memory GiB":12}   {"USD":<10}', end="")
-            print("  |  ", end="")
-            print(f'{"Instance Type":20} {"vCPU":6} {"Cores":6} {"Memory GiB":12}   {"USD":<10}')
-            print(f'{"-" * 6} {"-" * 6}   {"-" * 20} {"-" * 6} {"-" * 6} {"-" * 12}   {"-" * 10}', end="")
-            print("  |  ", end="")
-            print(f'{"-" * 20} {"-" * 6} {"-" * 6} {"-" * 12}   {"-" * 10}')
+        print_recommendation_header(args)
         for recommendation in recommendations:
-            x, y, memory, cpu_value = recommendation
-            print(f'{cpu_value:6} {memory:6}   {x["instance_type"]:20} {x["vcpu_value"]:6} {x["cores_value"]:6} {x["memory_gigas"]:12}   {x[price_key]:<10}', end="")
-            print("  |  ", end="")
-            print(f'{y["instance_type"]:20} {y["vcpu_value"]:6} {y["cores_value"]:6} {y["memory_gigas"]:12}   {y[price_key]:<10}')
+            print_recommendation_row(recommendation, price_key)
     elif output == "json":
         print(json.dumps(recommendations, indent=2))
     else:
         print("ERROR - Invalid output option, please investigate!")
 
 
+# Follow
+def parse_source_line(line: str, args: any) -> tuple:
+    if args.file_type == "tsv":
+        line = line.replace("\t", " ").strip()
+    elif args.file_type == "csv":
+        line = line.replace(",", " ").strip()
+    else:
+        print("ERROR - Invalid source file type. Please investigate!!!")
+        return None
+    parts = line.split(" ")
+    memory = float(parts[int(args.memory_index)])
+    cpu_value = int(parts[int(args.cpu_index)])
+    return (memory, cpu_value)
+
+def get_checkpoint_file_name(args: any) -> str:
+    # Pipes can't be seeked, so there is nothing to resume from
+    if args.file == "-" or not os.path.isfile(args.file):
+        return ""
+    if args.checkpoint_file:
+        return args.checkpoint_file
+    return f"{args.file}.offset"
+
+def load_checkpoint_offset(checkpoint_file_name: str) -> int:
+    if not checkpoint_file_name or not os.path.isfile(checkpoint_file_name):
+        return 0
+    with open(checkpoint_file_name) as f:
+        offset = f.read().strip()
+    return int(offset) if offset else 0
+
+def save_checkpoint_offset(checkpoint_file_name: str, offset: int) -> None:
+    if not checkpoint_file_name:
+        return
+    # Write to temporary file and rename, so a crash never leaves a half written offset
+    temp_file_name = f"{checkpoint_file_name}.tmp"
+    with open(temp_file_name, "w") as f:
+        f.write(str(offset))
+    os.replace(temp_file_name, checkpoint_file_name)
+
+def follow_source_file(file_name: str, offset: int, interval: float):
+    # Yield (line, offset after line) for every complete line appended to the file,
+    # and (None, offset) when all of it was read or it starts over, so checkpoint can be saved.
+    # For regular files keep polling at the end and follow it when rotated by rename,
+    # for pipes stop when writer closes it.
+    is_regular_file = file_name != "-" and os.path.isfile(file_name)
+    f = sys.stdin.buffer if file_name == "-" else open(file_name, "rb")
+    try:
+        if is_regular_file:
+            if os.fstat(f.fileno()).st_size < offset:
+                # File was truncated since last checkpoint.
+                # A file rotated while not running is only detected if it is smaller than the checkpoint.
+                offset = 0
+            f.seek(offset)
+        pending = b""
+        while True:
+            chunk = f.readline()
+            if not chunk:
+                if not is_regular_file:
+                    # Writer closed the pipe, so the last row will never get its line break
+                    if pending.strip():
+                        offset += len(pending)
+                        yield pending.decode(errors="replace"), offset
+                    return
+                try:
+                    rotated = os.stat(file_name).st_ino != os.fstat(f.fileno()).st_ino
+                except FileNotFoundError:
+                    # Renamed away and the new one was not created yet
+                    rotated = False
+                if rotated:
+                    print(f"WARNING - File '{file_name}' was rotated, starting from the beginning of the new one", file=sys.stderr)
+                    # Old file will not grow anymore, so the last row will never get its line break
+                    if pending.strip():
+                        offset += len(pending)
+                        yield pending.decode(errors="replace"), offset
+                    f.close()
+                    f = open(file_name, "rb")
+                    offset = 0
+                    pending = b""
+                    yield None, offset
+                    continue
+                if os.fstat(f.fileno()).st_size < offset + len(pending):
+                    print(f"WARNING - File '{file_name}' was truncated, starting from the beginning", file=sys.stderr)
+                    offset = 0
+                    pending = b""
+                    f.seek(0)
+                    yield None, offset
+                    continue
+                # Everything available was read, good time to save checkpoint before waiting
+                yield None, offset
+                time.sleep(interval)
+                continue
+            # Only complete lines are processed, partial one waits for the rest of it
+            pending += chunk
+            if not pending.endswith(b"\n"):
+                continue
+            offset += len(pending)
+            line = pending.decode(errors="replace")
+            pending = b""
+            yield line, offset
+    finally:
+        if f is not sys.stdin.buffer:
+            f.close()
+
+def follow_instance_recommendation(table: dict, price_key: str, cpu_key: str, args: any) -> None:
+    checkpoint_file_name = get_checkpoint_file_name(args)
+    offset = load_checkpoint_offset(checkpoint_file_name)
+
+    output = args.output
+    if output == "table":
+        print_recommendation_header(args)
+        sys.stdout.flush()
+    elif output != "json":
+        print("ERROR - Invalid output option, please investigate!")
+        return
+
+    # Checkpoint is saved when all rows available were read, before waiting for more,
+    # every some rows or seconds while catching up or a busy writer keeps it from the end, and on exit.
+    # Only offsets of rows already emitted are saved, a restart may repeat a row but never lose one.
+    checkpoint_offset = offset
+    saved_offset = offset
+    saved_time = time.monotonic()
+    rows_since_saved = 0
+
+    # Stopped by service manager or container runtime must save checkpoint too
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        for line, offset in follow_source_file(args.file, offset, args.follow_interval):
+            if line is not None:
+                rows_since_saved += 1
+            if line is not None and line.strip():
+                # One bad row must not stop following, it is skipped and checkpoint goes past it
+                try:
+                    instance_to_match = parse_source_line(line, args)
+                    if instance_to_match is None:
+                        return
+                    recommendation = get_instance_recommendation(table, instance_to_match, price_key, cpu_key, args)
+                except (ValueError, IndexError) as e:
+                    print(f"WARNING - Row '{line.strip()}' skipped: {e}", file=sys.stderr)
+                else:
+                    if output == "table":
+                        print_recommendation_row(recommendation, price_key)
+                    else:
+                        # One JSON document per line, so it can be consumed while still running
+                        print(json.dumps(recommendation))
+                    sys.stdout.flush()
+            checkpoint_offset = offset
+
+            # Idle polls don't write the same checkpoint again
+            if checkpoint_offset != saved_offset and (line is None or rows_since_saved >= args.checkpoint_rows or time.monotonic() - saved_time >= args.checkpoint_seconds):
+                save_checkpoint_offset(checkpoint_file_name, checkpoint_offset)
+                saved_offset = checkpoint_offset
+                saved_time = time.monotonic()
+                rows_since_saved = 0
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if checkpoint_offset != saved_offset:
+            save_checkpoint_offset(checkpoint_file_name, checkpoint_offset)
+
+
+# Consolidate
+def get_direct_match_cached(table: dict, price_key: str, memory: float, cpu_key: str, cpu_value: int, cache: dict) -> dict:
+    key = (memory, cpu_value)
+    if key not in cache:
+        # Same selection as direct-match, without debug output, and None when there is no instance type big enough
+        cache[key] = select_lowest_price(table, price_key, lambda x: x["memory_gigas"] >= memory and x[cpu_key] >= cpu_value)
+    return cache[key]
+
+def get_memory_mib(memory: float) -> int:
+    return round(memory * 1024)
+
+def get_consolidate_instance_types(table: dict, price_key: str, cpu_key: str) -> list[dict]:
+    # Biggest instance type of each family, it is the one that packs more demands
+    families = {}
+    records = table["records"]
+    for index in get_price_order(table, price_key):
+        x = records[index]
+        family = x["instance_family"]
+        if family not in families or (x["memory_gigas"], x[cpu_key]) > (families[family]["memory_gigas"], families[family][cpu_key]):
+            families[family] = x
+    return list(families.values())
+
+def get_consolidate_instance_type(instance_types: list[dict], price_key: str, memory: float, cpu_key: str, cpu_value: int) -> dict:
+    # Cheapest share of the instance used by the demand, the biggest resource used defines the share
+    selected = None
+    selected_cost = 0
+    for x in instance_types:
+        if x["memory_gigas"] < memory or x[cpu_key] < cpu_value:
+            continue
+        cost = x[price_key] * max(memory / x["memory_gigas"], cpu_value / x[cpu_key])
+        if selected is None or (cost, x["id"]) < (selected_cost, selected["id"]):
+            selected = x
+            selected_cost = cost
+    return selected
+
+def consolidate_instances(table: dict, instances_to_match: list[tuple], price_key: str, cpu_key: str, args: any) -> dict:
+    start = time.monotonic()
+    cache = {}
+
+    # Demands are split by the instance type they will be packed on
+    instance_types = get_consolidate_instance_types(table, price_key, cpu_key)
+    instance_type_cache = {}
+    groups = {}
+    unmatched = []
+    for demand in instances_to_match:
+        if demand not in instance_type_cache:
+            memory, cpu_value = demand
+            instance_type_cache[demand] = get_consolidate_instance_type(instance_types, price_key, memory, cpu_key, cpu_value)
+        instance_type = instance_type_cache[demand]
+        if instance_type is None:
+            unmatched.append(demand)
+            continue
+        if instance_type["id"] not in groups:
+            groups[instance_type["id"]] = (instance_type, [])
+        groups[instance_type["id"]][1].append(demand)
+
+    bins = []
+    budget_exhausted = False
+    for instance_type, demands in groups.values():
+        # Best-fit decreasing, biggest demands first relative to the instance type used to pack them.
+        # Memory and cpu are added, so demands heavy on both go before the ones heavy on only one
+        demands.sort(key=lambda x: x[0] / instance_type["memory_gigas"] + x[1] / instance_type[cpu_key], reverse=True)
+
+        # Index has open instances grouped by cpu free, each group sorted by (memory free, bin).
+        # Best fit: the open instance with the least cpu free that fits the demand,
+        # then the least memory free on it, both found by bisect
+        # Memory is counted in MiB integers, float sums would drift and fail exact fits
+        bin_index = {}
+        bin_index_keys = []
+        min_memory_mib = min(get_memory_mib(x[0]) for x in demands)
+        min_cpu_value = min(x[1] for x in demands)
+        for memory, cpu_value in demands:
+            memory_mib = get_memory_mib(memory)
+            placed = False
+            if not budget_exhausted and time.monotonic() - start > args.consolidate_time_limit:
+                # Out of time, remaining demands open new instances without searching the open ones
+                budget_exhausted = True
+            if not budget_exhausted:
+                position = bisect.bisect_left(bin_index_keys, cpu_value)
+                for cpu_free in bin_index_keys[position:position + args.consolidate_max_scan]:
+                    bins_free = bin_index[cpu_free]
+                    index = bisect.bisect_left(bins_free, (memory_mib, -1))
+                    if index < len(bins_free):
+                        _, bin_id = bins_free.pop(index)
+                        if not bins_free:
+                            del bin_index[cpu_free]
+                            bin_index_keys.remove(cpu_free)
+                        current = bins[bin_id]
+                        placed = True
+                        break
+
+            if not placed:
+                bin_id = len(bins)
+                current = {
+                    "instance": instance_type,
+                    "memory_free": get_memory_mib(instance_type["memory_gigas"]),
+                    "cpu_free": instance_type[cpu_key],
+                    "memory_used": 0,
+                    "cpu_used": 0,
+                    "demands": 0,
+                    "members": [],
+                }
+                bins.append(current)
+
+            current["memory_free"] -= memory_mib
+            current["cpu_free"] -= cpu_value
+            current["memory_used"] += memory_mib
+            current["cpu_used"] += cpu_value
+            current["demands"] += 1
+            current["members"].append((memory, cpu_value))
+            # Instances without room for the smallest demand are not indexed anymore
+            if current["memory_free"] >= min_memory_mib and current["cpu_free"] >= min_cpu_value:
+                if current["cpu_free"] not in bin_index:
+                    bin_index[current["cpu_free"]] = []
+                    bisect.insort(bin_index_keys, current["cpu_free"])
+                bisect.insort(bin_index[current["cpu_free"]], (current["memory_free"], bin_id))
+
+    # Back to GiB, MiB divided by 1024 is exact
+    for current in bins:
+        current["memory_used"] = current["memory_used"] / 1024
+
+    # Downsize every instance to the cheapest one that still fits what was packed on it
+    for current in bins:
+        selected = get_direct_match_cached(table, price_key, current["memory_used"], cpu_key, current["cpu_used"], cache)
+        if selected is not None and selected[price_key] < current["instance"][price_key]:
+            current["instance"] = selected
+
+    # Cheaper small types can make an instance cost more than one instance for each demand packed on it,
+    # those are unpacked, so consolidated cost is never higher than one-to-one
+    unpacked_bins = []
+    for current in bins:
+        members = [ get_direct_match_cached(table, price_key, memory, cpu_key, cpu_value, cache) for memory, cpu_value in current["members"] ]
+        if sum(x[price_key] for x in members) >= current["instance"][price_key]:
+            unpacked_bins.append(current)
+            continue
+        for (memory, cpu_value), selected in zip(current["members"], members):
+            unpacked_bins.append({
+                "instance": selected,
+                "memory_used": memory,
+                "cpu_used": cpu_value,
+                "demands": 1,
+                "members": [(memory, cpu_value)],
+            })
+    bins = unpacked_bins
+
+    # One instance per demand, same as direct-match recommendation
+    one_to_one_cost = 0
+    for memory, cpu_value in instances_to_match:
+        selected = get_direct_match_cached(table, price_key, memory, cpu_key, cpu_value, cache)
+        if selected is not None:
+            one_to_one_cost += selected[price_key]
+
+    consolidated_cost = sum(current["instance"][price_key] for current in bins)
+    return {
+        "demands": len(instances_to_match),
+        "instances": len(bins),
+        "unmatched": unmatched,
+        "consolidated_cost": consolidated_cost,
+        "one_to_one_cost": one_to_one_cost,
+        "savings": one_to_one_cost - consolidated_cost,
+        "budget_exhausted": budget_exhausted,
+        "seconds": time.monotonic() - start,
+        "bins": [
+            {
+                "instance_type": current["instance"]["instance_type"],
+                "vcpu_value": current["instance"]["vcpu_value"],
+                "cores_value": current["instance"]["cores_value"],
+                "memory_gigas": current["instance"]["memory_gigas"],
+                "price": current["instance"][price_key],
+                "memory_used": current["memory_used"],
+                "cpu_used": current["cpu_used"],
+                "demands": current["demands"],
+            }
+            for current in bins
+        ],
+    }
+
+def print_instance_consolidation(table: dict, instances_to_match: list[tuple], price_key: str, cpu_key: str, args: any) -> None:
+    consolidation = consolidate_instances(table, instances_to_match, price_key, cpu_key, args)
+
+    output = args.output
+    if output == "table":
+        # Group instances by type
+        instance_types = {}
+        for x in consolidation["bins"]:
+            if x["instance_type"] not in instance_types:
+                instance_types[x["instance_type"]] = dict(x, count=0, total=0)
+            instance_types[x["instance_type"]]["count"] += 1
+            instance_types[x["instance_type"]]["total"] += x["price"]
+
+        table_header = args.table_header
+        if table_header:
+            print(f'{"Instance Type":20} {"vCPU":6} {"Cores":6} {"Memory GiB":12}   {"Count":8} {"USD":<10} {"USD Total":<15}')
+            print(f'{"-" * 20} {"-" * 6} {"-" * 6} {"-" * 12}   {"-" * 8} {"-" * 10} {"-" * 15}')
+        for x in sorted(instance_types.values(), key=lambda x: x["total"], reverse=True):
+            print(f'{x["instance_type"]:20} {x["vcpu_value"]:6} {x["cores_value"]:6} {x["memory_gigas"]:12}   {x["count"]:8} {x["price"]:<10} {x["total"]:<15.4f}')
+        print()
+        savings_percent = consolidation["savings"] / consolidation["one_to_one_cost"] * 100 if consolidation["one_to_one_cost"] > 0 else 0
+        print(f'Demands:           {consolidation["demands"]}')
+        print(f'Unmatched:         {len(consolidation["unmatched"])}')
+        print(f'Instances:         {consolidation["instances"]}')
+        print(f'USD consolidated:  {consolidation["consolidated_cost"]:.4f}')
+        print(f'USD one-to-one:    {consolidation["one_to_one_cost"]:.4f}')
+        print(f'USD savings:       {consolidation["savings"]:.4f} ({savings_percent:.2f}%)')
+        if consolidation["budget_exhausted"]:
+            print(f'WARNING - Time limit reached after {consolidation["seconds"]:.2f}s, remaining demands were not packed on open instances')
+    elif output == "json":
+        print(json.dumps(consolidation, indent=2))
+    else:
+        print("ERROR - Invalid output option, please investigate!")
+
+
 # List all
 def print_instance(instances: list[dict], args: any) -> None:
-    if not args.debug_right_size and not args.debug_direct_match:
-        sort_by = {
-            "id": "id",
-            "type": "instance_type",
-            "vcpu": "vcpu_value",
-            "cores": "cores_value",
-            "memory": "memory_gigas",
-            "ondemand": "price_ondemand",
-            "nuri3ystd": "price_nuri_3yr_standard",
-            "nuri1ystd": "price_nuri_1yr_standard",
-            "nuri3yrconv": "price_nuri_3yr_convertible",
-            "nuri1yrconv": "price_nuri_1yr_convertible",
-        }
-        instances = sorted(instances, key=lambda x: x[sort_by[args.sort_by]], reverse=args.reverse)
-
     output = args.output
     if output == "table":
         table_header = args.table_header
@@ -355,6 +823,53 @@ def print_instance(instances: list[dict], args: any) -> None:
         print("ERROR - Invalid output option, please investigate!")
 
 
+# Rank
+def get_instance_ranked(price_list: list[dict], unit_price_key: str, group_key: str, top: int) -> dict:
+    groups = {}
+    for x in price_list:
+        # Without price there is nothing to rank
+        if x[unit_price_key] <= 0:
+            continue
+        if group_key == "category":
+            group = x["product"]["attributes"]["instanceFamily"]
+        else:
+            group = x["instance_family"]
+        if group not in groups:
+            groups[group] = []
+        groups[group].append(x)
+
+    # Only top N is required, no need to sort the whole group
+    ranked = {}
+    for group, instances in groups.items():
+        ranked[group] = heapq.nsmallest(top, instances, key=lambda x: (x[unit_price_key], x["id"]))
+    return ranked
+
+def print_instance_ranked(price_list: list[dict], price_key: str, args: any) -> None:
+    # Same names used by --sort-by and --cores
+    rank_by = {
+        "gib": ("per_gib", "GiB"),
+        "vcpu": ("per_vcpu", "vCPU"),
+        "cores": ("per_core", "Core"),
+    }
+    unit_key, unit_name = rank_by[args.rank_by]
+    unit_price_key = f"{price_key}_{unit_key}"
+    ranked = get_instance_ranked(price_list, unit_price_key, args.group_by, args.top)
+
+    output = args.output
+    if output == "table":
+        table_header = args.table_header
+        if table_header:
+            print(f'{"Group":30}  {"Rank":4}  {"Instance Type":20} {"vCPU":6} {"Cores":6} {"Memory GiB":12}     {"USD":<10} {"USD per " + unit_name:<15}')
+            print(f'{"-" * 30}  {"-" * 4}  {"-" * 20} {"-" * 6} {"-" * 6} {"-" * 12}     {"-" * 10} {"-" * 15}')
+        for group in sorted(ranked.keys()):
+            for rank, x in enumerate(ranked[group], start=1):
+                print(f'{group:30}  {rank:4}  {x["instance_type"]:20} {x["vcpu_value"]:6} {x["cores_value"]:6} {x["memory_gigas"]:12}     {x[price_key]:<10} {x[unit_price_key]:<15.6f}')
+    elif output == "json":
+        print(json.dumps(ranked, indent=2))
+    else:
+        print("ERROR - Invalid output option, please investigate!")
+
+
 # Category
 def get_instance_sorted_by_category(price_list: list[dict]) -> dict:
     categories = {}
@@ -417,7 +932,9 @@ def main():
     category_output_choices = ["short", "table"]
     source_file_type_choices = ["csv", "tsv"]
     hypervisor_choices = ["nitro", "xen"]
-    sort_by_choices = ["id", "type", "vcpu", "cores", "memory", "ondemand", "nuri3ystd", "nuri1ystd", "nuri3yconv", "nuri1yconv"]
+    rank_by_choices = ["gib", "vcpu", "cores"]
+    group_by_choices = ["category", "family"]
+    sort_by_choices = list(SORT_BY_KEYS.keys())
 
     description ="""
     Get instance recommendation from AWS pricing.
@@ -431,6 +948,8 @@ def main():
     For direct-match,
       CPU and Memory recommendation will always be equal or higher.
 
+    If only one of them finds an instance type, the other is shown empty ('-' on table, null on json).
+
     Attention:
       If there is a price but instance type is not available on describe of the region, it will be removed from list!
       Use only current instance types generation!
@@ -462,6 +981,13 @@ def main():
     group_source.add_argument("--cpu", help="CPU value")
     group_source.add_argument("--memory", help="Memory (in GiB) value")
 
+    group_follow = parser.add_argument_group("Follow", "Keep price list loaded and match rows as they are appended to source file")
+    group_follow.add_argument("--follow", help="Follow source file (or pipe, use '-' for stdin) and match only new rows", default=False, action=argparse.BooleanOptionalAction)
+    group_follow.add_argument("--follow-interval", help="Seconds to wait before checking source file for new rows. Default: '1.0'", type=float, default=1.0)
+    group_follow.add_argument("--checkpoint-file", help="File to save source file offset, so restart resumes from last matched row. Default: '<file>.offset'")
+    group_follow.add_argument("--checkpoint-rows", help="Save checkpoint at least every N rows, even before reaching the end of source file. Default: '1000'", type=int, default=1000)
+    group_follow.add_argument("--checkpoint-seconds", help="Save checkpoint at least every N seconds, even before reaching the end of source file. Default: '5.0'", type=float, default=5.0)
+
     group_output = parser.add_argument_group("Output", "Output options")
     group_output.add_argument("--output", help=f"Output format. Default: '{output_choices[0]}'", choices=output_choices, default=output_choices[0])
     group_output.add_argument("--table-header", help="Show table header", default=True, action=argparse.BooleanOptionalAction)
@@ -492,6 +1018,17 @@ def main():
     group_list_all.add_argument("--sort-by", help=f"Sort price list. Default: '{sort_by_choices[0]}'", choices=sort_by_choices, default=sort_by_choices[0])
     group_list_all.add_argument("--reverse", help="Sort in reverse order?", default=False, action=argparse.BooleanOptionalAction)
 
+    group_consolidate = parser.add_argument_group("Consolidate", "Pack all demands from source on the cheapest set of instances, instead of one instance per demand")
+    group_consolidate.add_argument("--consolidate", help="Consolidate demands from source and compare total cost with one-to-one direct-match", default=False, action=argparse.BooleanOptionalAction)
+    group_consolidate.add_argument("--consolidate-time-limit", help="Seconds to search open instances before opening a new one for every remaining demand. Default: '10.0'", type=float, default=10.0)
+    group_consolidate.add_argument("--consolidate-max-scan", help="Max groups of open instances with same cpu free checked per demand. Default: '64'", type=int, default=64)
+
+    group_rank = parser.add_argument_group("Rank", "Rank cheapest instance types by unit price, grouped by instance category or family. Requires 'On-Demand' or 'Reserved'")
+    group_rank.add_argument("--rank", help="List top N instance types with lowest price per unit on each group", default=False, action=argparse.BooleanOptionalAction)
+    group_rank.add_argument("--rank-by", help=f"Unit to divide price by. Default: '{rank_by_choices[0]}'", choices=rank_by_choices, default=rank_by_choices[0])
+    group_rank.add_argument("--group-by", help=f"Group instance types by category (instanceFamily) or family. Default: '{group_by_choices[0]}'", choices=group_by_choices, default=group_by_choices[0])
+    group_rank.add_argument("--top", help="Number of instance types to show per group. Default: '5'", type=int, default=5)
+
     group_category = parser.add_argument_group("List Category", "List instance type grouped by instance category")
     group_category.add_argument("--list-category", help="List all instance types grouped by instance category", default=False, action=argparse.BooleanOptionalAction)
     group_category.add_argument("--category-output", help=f"Output format for instance category. Default: '{category_output_choices[0]}'", choices=category_output_choices, default=category_output_choices[0])
@@ -508,13 +1045,34 @@ def main():
     # Validate parameters
     if args.list_attribute and not args.attribute:
         parser.error("Parameter 'attribute' must be set when use 'list-attribute'")
+    if args.consolidate:
+        if args.follow:
+            parser.error("Parameter 'consolidate' cannot be used together with 'follow'")
+        if args.consolidate_max_scan < 1:
+            parser.error("Parameter 'consolidate-max-scan' must be greater than zero")
+    if args.rank:
+        if args.top < 1:
+            parser.error("Parameter 'top' must be greater than zero")
+        for conflict in ["file", "direct", "follow", "consolidate"]:
+            if getattr(args, conflict):
+                parser.error(f"Parameter '{conflict}' cannot be used together with 'rank'")
     if args.file:
         if not args.cpu_index:
             parser.error("Parameter 'cpu-index' must be set when use 'file'")
         if not args.memory_index:
             parser.error("Parameter 'memory-index' must be set when use 'file'")
-        if not os.path.isfile(args.file):
+        if args.follow:
+            if args.file != "-" and not os.path.exists(args.file):
+                parser.error(f"File '{args.file}' not found")
+        elif not os.path.isfile(args.file):
             parser.error(f"File '{args.file}' not found")
+    if args.follow:
+        if not args.file:
+            parser.error("Parameter 'file' must be set when use 'follow'")
+        if args.direct:
+            parser.error("Parameter 'direct' cannot be used together with 'follow'")
+        if args.checkpoint_rows < 1:
+            parser.error("Parameter 'checkpoint-rows' must be greater than zero")
 
     # memory_limits = []
     # if args.memory_limits:
@@ -597,9 +1155,12 @@ def main():
         print_attribute(price_list, args)
         return
 
+    # Orders are shared by every query below
+    table = build_price_table(price_list)
+
     # List all instance types on teh same order it was loaded
     if args.list_all:
-        print_instance(price_list, args)
+        print_instance(get_instance_sorted(table, args.sort_by, args.reverse), args)
         return
 
 
@@ -620,7 +1181,13 @@ def main():
         "convertible-3yr": "price_nuri_3yr_convertible",
     }
     price_key = price_options[selcted_price]
-    price_sorted = price_list_sorted(price_list, price_key)
+
+    # Rank by unit price
+    # It doesn't require to sort the price list
+    if args.rank:
+        print_instance_ranked(price_list, price_key, args)
+        return
+
 
     if args.vcpu:
         cpu_key = "vcpu_value"
@@ -630,6 +1197,11 @@ def main():
         print("ERROR - Please select 'vcpu' or 'cores'")
         return
 
+    # Catalogue stays loaded, only rows appended to source are matched
+    if args.follow:
+        follow_instance_recommendation(table, price_key=price_key, cpu_key=cpu_key, args=args)
+        return
+
     instances_to_match = []
     if args.direct:
         memory = float(args.memory)
@@ -641,19 +1213,18 @@ def main():
 
         
         for line in source_lines:
-            if args.file_type == "tsv":
-                line = line.replace("\t", " ").strip()
-            elif args.file_type == "csv":
-                line = line.replace(",", " ").strip()
-            else:
-                print("ERROR - Invalid source file type. Please investigate!!!")
+            if not line.strip():
+                continue
+            instance_to_match = parse_source_line(line, args)
+            if instance_to_match is None:
                 return
-            parts = line.split(" ")
-            memory = float(parts[int(args.memory_index)])
-            cpu_value = int(parts[int(args.cpu_index)])
-            instances_to_match.append((memory, cpu_value))
+            instances_to_match.append(instance_to_match)
+
+    if args.consolidate:
+        print_instance_consolidation(table, instances_to_match, price_key=price_key, cpu_key=cpu_key, args=args)
+        return
 
-    print_instance_recommendation(price_sorted, instances_to_match, price_key=price_key, cpu_key=cpu_key, args=args) # , memory_limits=memory_limits, cpu_limits=cpu_limits
+    print_instance_recommendation(table, instances_to_match, price_key=price_key, cpu_key=cpu_key, args=args) # , memory_limits=memory_limits, cpu_limits=cpu_limits
 
 if __name__ == "__main__":
     main()
\ No newline at end of file